@@ -5,6 +5,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint_sequential
 
 
 class Bottleneck(nn.Module):
@@ -197,6 +198,8 @@ class Transformer(nn.Module):
         self.width = width
         self.layers = layers
         self.resblocks = nn.Sequential(*[ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
+        self.checkpoint_segments = 0  # > 0 enables gradient checkpointing
+        self.checkpoint_preserve_rng = True  # only needed if the blocks use dropout, see enable_grad_checkpointing
 
     def get_last_hidden_states(self, to_tensor=True):
         hs = [block.last_input for block in self.resblocks]
@@ -205,6 +208,9 @@ class Transformer(nn.Module):
         return hs
 
     def forward(self, x: torch.Tensor):
+        if self.checkpoint_segments > 0 and torch.is_grad_enabled():
+            return checkpoint_sequential(self.resblocks, self.checkpoint_segments, x, use_reentrant=False,
+                                         preserve_rng_state=self.checkpoint_preserve_rng)
         return self.resblocks(x)
 
 
@@ -356,7 +362,7 @@ class CLIP(nn.Module):
 
         # x.shape = [batch_size, n_ctx, transformer.width]
         # take features from the eot embedding (eot_token is the highest number in each sequence)
-        x = x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
+        x = x[torch.arange(x.shape[0], device=x.device), text.argmax(dim=-1)] @ self.text_projection
 
         return x
 
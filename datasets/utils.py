@@ -430,7 +430,8 @@ def build_data_loader(
         num_workers=num_workers,
         shuffle=shuffle,
         drop_last=False,
-        pin_memory=(torch.cuda.is_available())
+        pin_memory=(torch.cuda.is_available()),
+        persistent_workers=(num_workers > 0)
     )
     assert len(data_loader) > 0
 
@@ -1,50 +1,45 @@
 import torch
-import torch.nn.functional as F
 
-from contextlib import nullcontext
-from fs.utils.model_utils import trainable_norm_params
-from fs.utils.eval_utils import tokenize_texts, cls_acc, evaluate
+from fs.utils.model_utils import trainable_norm_params, freeze_all_but, fuse_layer_norms, enable_grad_checkpointing, compile_encoders, autocast_dtype
+from fs.utils.eval_utils import tokenize_texts, encode_texts, num_correct, evaluate
+from fs.utils.train_utils import make_train_step, capture_train_step
 
 
-def train_epoch(clip_model, optimizer, scheduler, scaler, train_loader, tokenized_texts, count_iters, total_iters, args):
+def train_epoch(clip_model, optimizer, scheduler, scaler, train_loader, tokenized_texts, count_iters, total_iters, args, frozen_text_features=None, graphed_step=None):
     clip_model.train()
-    acc_train = 0
+    acc_train = torch.zeros((), device='cuda')
     tot_samples = 0
-    loss_epoch = 0.
+    loss_epoch = torch.zeros((), device='cuda')
 
-    text_context_manager = torch.no_grad if args.ln_modality == 'vision' else nullcontext
-    vision_context_manager = torch.no_grad if args.ln_modality == 'text' else nullcontext
+    # by default only the last epoch is logged, so skip the bookkeeping for the others
+    log_epoch = args.verbose_every_epoch or args.debug or count_iters + len(train_loader) >= total_iters
+
+    train_step = make_train_step(clip_model, optimizer, scaler, tokenized_texts, args, frozen_text_features)
 
     for i, (images, target) in enumerate(train_loader):
         
-        # move data to GPU
-        images, target = images.cuda(), target.cuda()
-
-        # get both text and image features
-        # wrapping the forward pass in autocast
-        with torch.amp.autocast('cuda', dtype=torch.float16):
-            with text_context_manager():
-                text_features = clip_model.encode_text(tokenized_texts)
-            with vision_context_manager():
-                image_features = clip_model.encode_image(images)
-        
-        # well, you know that clip normalizes the features
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        
-        # compute loss and backward with scaling
-        cosine_similarity = clip_model.logit_scale.exp() * image_features @ text_features.t()
-        loss = F.cross_entropy(cosine_similarity, target)
-        scaler.scale(loss).backward()
-        scaler.step(optimizer)
+        # tell cuda graphs a new iteration starts (no-op unless the encoders are compiled)
+        torch.compiler.cudagraph_mark_step_begin()
+
+        # move data to GPU (channels_last matches the layout of the conv weights)
+        images = images.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        target = target.cuda(non_blocking=True)
+
+        # replay the recorded CUDA graph on full batches, run the training step eagerly otherwise
+        if graphed_step is not None and target.shape[0] == graphed_step.batch_size:
+            cosine_similarity, loss = graphed_step(images, target)
+        else:
+            # the graph owns the gradient buffers, so they can only be zeroed in place
+            optimizer.zero_grad(set_to_none=graphed_step is None)
+            cosine_similarity, loss = train_step(images, target)
         scheduler.step()
-        optimizer.zero_grad()
         scaler.update()
         
-        # compute accuracy and loss
-        acc_train += cls_acc(cosine_similarity, target) * target.shape[0]
-        loss_epoch += loss.item() * target.shape[0]
-        tot_samples += target.shape[0]
+        # compute accuracy and loss (accumulated on the GPU, so no sync at every step)
+        if log_epoch:
+            acc_train += num_correct(cosine_similarity, target)
+            loss_epoch += loss.detach() * target.shape[0]
+            tot_samples += target.shape[0]
         
         # check if we reached the total number of iterations
         count_iters += 1
@@ -52,9 +47,9 @@ def train_epoch(clip_model, optimizer, scheduler, scaler, train_loader, tokenize
             break
         
     # print after each epoch
-    if count_iters <= total_iters:
-        acc_train /= tot_samples
-        loss_epoch /= tot_samples
+    if log_epoch and count_iters <= total_iters:
+        acc_train = 100 * acc_train.item() / tot_samples
+        loss_epoch = loss_epoch.item() / tot_samples
         current_lr = scheduler.get_last_lr()[0]
         print('[{}/{}] LR: {:.6f}, Acc: {:.4f}, Loss: {:.4f}'.format(
             count_iters, total_iters, current_lr, acc_train, loss_epoch
@@ -68,26 +63,53 @@ def train_epoch(clip_model, optimizer, scheduler, scaler, train_loader, tokenize
 def run_ln_only(args, clip_model, logit_scale, dataset, train_loader, val_loader, test_loader):
     
     clip_model = clip_model.cuda().float()
+    if args.grad_ckpt:
+        clip_model = enable_grad_checkpointing(clip_model)
+    clip_model.visual = clip_model.visual.to(memory_format=torch.channels_last)
+    if args.compile:
+        clip_model = compile_encoders(clip_model)
     total_iters = args.n_iters * args.shots
     
     # train only layer-norm instances
+    if args.fused_ln:
+        clip_model = fuse_layer_norms(clip_model)
     trainable_params = trainable_norm_params(
         clip_model, 
         modality=args.ln_modality, 
         vision_start=args.ln_vision_start, 
         text_start=args.ln_text_start
     )
-    optimizer = torch.optim.AdamW(trainable_params, lr=args.lr, weight_decay=args.wd, betas=(0.9, 0.999))
+    clip_model = freeze_all_but(clip_model, trainable_params)
+
+    # a CUDA graph reads the lr from device memory, so it must be a tensor the scheduler updates in place
+    lr = torch.tensor(args.lr, device='cuda') if args.cuda_graph else args.lr
+    optimizer = torch.optim.AdamW(trainable_params, lr=lr, weight_decay=args.wd, betas=(0.9, 0.999), fused=True, capturable=bool(args.cuda_graph))
     print(f"Using AdamW with lr={args.lr}, wd={args.wd}, betas=(0.9, 0.999).")
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, total_iters, eta_min=1e-6)
     
     # training 
-    scaler = torch.amp.GradScaler('cuda')
+    # loss scaling is only needed when falling back to fp16
+    scaler = torch.amp.GradScaler('cuda', enabled=autocast_dtype() == torch.float16)
     count_iters = 0
 
     # we only need to tokenize once
     tokenized_texts = tokenize_texts(template=dataset.template[0], classnames=dataset.classnames)
 
+    # when only tuning the vision encoder, the text features never change: encode them once
+    frozen_text_features = encode_texts(clip_model, tokenized_texts, dtype=autocast_dtype()) if args.ln_modality == 'vision' else None
+
+    # optionally record the whole training step once, and replay it for every full batch
+    graphed_step = None
+    if args.cuda_graph:
+        clip_model.train()
+        graphed_step = capture_train_step(
+            make_train_step(clip_model, optimizer, scaler, tokenized_texts, args, frozen_text_features),
+            optimizer,
+            scaler,
+            train_loader,
+            resolution=clip_model.visual.input_resolution
+        )
+
     # start training for a fixed number of gradient steps (total_iters)  
     while count_iters < total_iters:
         clip_model, count_iters = train_epoch(
@@ -99,7 +121,9 @@ def run_ln_only(args, clip_model, logit_scale, dataset, train_loader, val_loader
             tokenized_texts, 
             count_iters, 
             total_iters,
-            args
+            args,
+            frozen_text_features=frozen_text_features,
+            graphed_step=graphed_step
         )
 
         if args.debug: break
@@ -1,4 +1,3 @@
-import clip
 import torch
 import torch.nn.functional as F
 
@@ -7,7 +6,7 @@ from loralib.utils import (
     mark_only_lora_as_trainable, apply_lora, get_lora_parameters, 
     lora_state_dict, save_lora, load_lora
 )
-from fs.utils.eval_utils import clip_classifier, cls_acc, evaluate
+from fs.utils.eval_utils import clip_classifier, tokenize_texts, num_correct, evaluate
 
 
 def run_lora(args, clip_model, logit_scale, dataset, train_loader, val_loader, test_loader):
@@ -24,30 +23,30 @@ def run_lora(args, clip_model, logit_scale, dataset, train_loader, val_loader, t
     mark_only_lora_as_trainable(clip_model)
     total_iters = args.n_iters * args.shots
     
-    optimizer = torch.optim.AdamW(get_lora_parameters(clip_model), weight_decay=1e-2, betas=(0.9, 0.999), lr=args.lr)
+    optimizer = torch.optim.AdamW(get_lora_parameters(clip_model), weight_decay=1e-2, betas=(0.9, 0.999), lr=args.lr, fused=True)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, total_iters, eta_min=1e-6)
     
     # training LoRA
     scaler = torch.amp.GradScaler('cuda')
     count_iters = 0
+
+    # prompts never change during training, so tokenize them (and move them to the GPU) only once
+    tokenized_texts = tokenize_texts(template=dataset.template[0], classnames=dataset.classnames)
     
     while count_iters < total_iters:
         clip_model.train()
-        acc_train = 0
+        acc_train = torch.zeros((), device='cuda')
         tot_samples = 0
-        loss_epoch = 0.
+        loss_epoch = torch.zeros((), device='cuda')
         if args.encoder == 'vision': 
             text_features = textual_features.t().half()
         
         for i, (images, target) in enumerate(train_loader):
             
-            template = dataset.template[0]
-            texts = [template.format(classname.replace('_', ' ')) for classname in dataset.classnames]
-            images, target = images.cuda(), target.cuda()
+            images, target = images.cuda(non_blocking=True), target.cuda(non_blocking=True)
             if args.encoder == 'text' or args.encoder == 'both':
                 with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
-                    texts = clip.tokenize(texts).cuda()
-                    class_embeddings = clip_model.encode_text(texts)
+                    class_embeddings = clip_model.encode_text(tokenized_texts)
                 text_features = class_embeddings/class_embeddings.norm(dim=-1, keepdim=True)
                 
             if args.encoder == 'vision' or args.encoder == 'both':
@@ -60,11 +59,11 @@ def run_lora(args, clip_model, logit_scale, dataset, train_loader, val_loader, t
             image_features = image_features/image_features.norm(dim=-1, keepdim=True)
             
             cosine_similarity = logit_scale * image_features @ text_features.t()
-            loss = F.cross_entropy(cosine_similarity, target)
-            acc_train += cls_acc(cosine_similarity, target) * target.shape[0]
-            loss_epoch += loss.item() * target.shape[0]
+            loss = F.cross_entropy(cosine_similarity.float(), target)
+            acc_train += num_correct(cosine_similarity, target)
+            loss_epoch += loss.detach() * target.shape[0]
             tot_samples += target.shape[0]
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             scaler.scale(loss).backward()
             scaler.step(optimizer)
 
@@ -81,8 +80,8 @@ def run_lora(args, clip_model, logit_scale, dataset, train_loader, val_loader, t
                 break
             
         if count_iters <= total_iters:
-            acc_train /= tot_samples
-            loss_epoch /= tot_samples
+            acc_train = 100 * acc_train.item() / tot_samples
+            loss_epoch = loss_epoch.item() / tot_samples
             current_lr = scheduler.get_last_lr()[0]
             print('[{}/{}] LR: {:.6f}, Acc: {:.4f}, Loss: {:.4f}'.format(count_iters, total_iters, current_lr, acc_train, loss_epoch))
 
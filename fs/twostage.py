@@ -5,14 +5,17 @@ import torch.nn.functional as F
 from contextlib import nullcontext
 from loralib import apply_lora, mark_only_lora_as_trainable, get_lora_parameters
 
-from fs.utils.eval_utils import tokenize_texts, cls_acc
-from fs.utils.model_utils import trainable_norm_params, trainable_bias_params, num_params
+from fs.utils.eval_utils import tokenize_texts, encode_texts, num_correct
+from fs.utils.model_utils import trainable_norm_params, freeze_all_but, fuse_layer_norms, enable_grad_checkpointing, trainable_bias_params, num_params, compile_encoders, autocast_dtype
+from fs.utils.train_utils import make_train_step, capture_train_step
 
 
 def prepare_for_first_stage(clip_model, args):
     vision_start = args.ln_vision_start
     text_start = args.ln_text_start
     if args.peft == "ln":
+        if args.fused_ln:
+            clip_model = fuse_layer_norms(clip_model)
         trainable_params = trainable_norm_params(
             clip_model, 
             modality=args.ln_modality, 
@@ -32,12 +35,13 @@ def prepare_for_first_stage(clip_model, args):
             vision_start=vision_start
         )
     
+    clip_model = freeze_all_but(clip_model, trainable_params)
     return clip_model, trainable_params
 
 
 
 class SingleStreamClassifier(nn.Module):
-    def __init__(self, clip_model, classnames, template="a photo of a {}."):
+    def __init__(self, clip_model, classnames, template="a photo of a {}.", compile_backbone=False):
         super(SingleStreamClassifier, self).__init__()
 
         # let's keep a reference to the clip model (we will use it in the infer method)
@@ -45,12 +49,15 @@ class SingleStreamClassifier(nn.Module):
         
         # and also a reference to the visual backbone (handy for training code)
         self.backbone = clip_model.visual
+        if compile_backbone:
+            self.backbone = torch.compile(self.backbone, mode="reduce-overhead", dynamic=False)
         
         # linear classifier initialized with the text features of CLIP
         self._init_classifier(template, classnames)
 
-        # also inherit the default temperature without changing it
+        # also inherit the default temperature without changing it (and exp() it only once)
         self.logit_scale = clip_model.logit_scale
+        self._scale = self.logit_scale.detach().exp().item()
 
         # create a map from category to embedding
         self.cat2id = {cat: i for i, cat in enumerate(classnames)}
@@ -59,20 +66,20 @@ class SingleStreamClassifier(nn.Module):
     def _init_classifier(self, template, classnames):
         with torch.no_grad():
             texts = tokenize_texts(template=template, classnames=classnames)
-            with torch.amp.autocast('cuda'):
-                class_embeddings = self.clip_model.encode_text(texts)
-            class_embeddings = class_embeddings / class_embeddings.norm(dim=-1, keepdim=True)
-        self.classifier = nn.Parameter(class_embeddings.float(), requires_grad=True)
+            class_embeddings = encode_texts(self.clip_model, texts)
+            # normalize again after upcasting, so training starts from rows that are unit-norm in fp32 too
+            class_embeddings = F.normalize(class_embeddings.float(), dim=-1)
+        self.classifier = nn.Parameter(class_embeddings, requires_grad=True)
 
 
     def forward(self, x, no_grad_backbone=False):
         backbone_context_manager = torch.no_grad if no_grad_backbone else nullcontext
         with backbone_context_manager():
             x = self.backbone(x) 
-        x = x / x.norm(dim=-1, keepdim=True)
+        x = F.normalize(x, dim=-1)
         
-        classifier = self.classifier / self.classifier.norm(dim=-1, keepdim=True)
-        logits = self.logit_scale.exp() * x @ classifier.t()
+        classifier = F.normalize(self.classifier, dim=-1)
+        logits = F.linear(x, classifier).mul_(self._scale)
         return logits
     
 
@@ -86,30 +93,35 @@ class SingleStreamClassifier(nn.Module):
             classifier = self.inference_classifier
         else:
             # category-level inference; we only embed the categories that are not in the classifier already
-            missing_classnames = [cat for cat in categories if cat not in self.cat2id]
-            texts = tokenize_texts(template=template, classnames=missing_classnames)
-            with torch.amp.autocast('cuda'):
-                new_embeddings = self.clip_model.encode_text(texts)
-            cat2new = {cat: new for cat, new in zip(missing_classnames, new_embeddings)}
+            missing_classnames = list(dict.fromkeys(cat for cat in categories if cat not in self.cat2id))
+            embeddings = F.normalize(self.classifier, dim=-1)
+            if len(missing_classnames) > 0:
+                texts = tokenize_texts(template=template, classnames=missing_classnames)
+                new_embeddings = encode_texts(self.clip_model, texts)
+                embeddings = torch.cat([embeddings, F.normalize(new_embeddings.float(), dim=-1)])
             
-            # while for categories in the classifier, we simply pre-pick them
-            cat2known = {cat: self.classifier[self.cat2id[cat], :] for cat in categories if cat in self.cat2id}
+            # known categories index the rows of the learned classifier, new ones the rows appended after it
+            cat2row = {cat: len(self.cat2id) + i for i, cat in enumerate(missing_classnames)}
+            rows = [self.cat2id[cat] if cat in self.cat2id else cat2row[cat] for cat in categories]
 
-            # now we stack everything into a single classifier
+            # now we gather everything into a single classifier
             # NOTE: for the simplified and controlled scenario of base2novel / all2all Few-Shot Learning, 
             # you don't need this implementation; however, this will also work 
             # in real-world scenarios where the distinction is only revealed on a per-sample basis
-            classifier = [cat2new[cat] if cat in cat2new else cat2known[cat] for cat in categories]        
-            classifier = torch.stack(classifier).to(x)
-            classifier = classifier / classifier.norm(dim=-1, keepdim=True)
+            classifier = embeddings.index_select(0, torch.tensor(rows, device=embeddings.device))
+
+            # the cached classifier is frozen: store it normalized and in the dtype used by the matmul,
+            # so that later batches don't have to renormalize or recast it
+            dtype = torch.get_autocast_dtype('cuda') if torch.is_autocast_enabled('cuda') else x.dtype
+            classifier = classifier.to(device=x.device, dtype=dtype)
             self.inference_classifier = classifier
 
         # process the visual input
         x = self.backbone(x) 
-        x = x / x.norm(dim=-1, keepdim=True)
+        x = F.normalize(x, dim=-1)
 
         # then use the updated classifier to predict the current samples
-        logits = self.logit_scale.exp() * x @ classifier.t()
+        logits = F.linear(x, classifier).mul_(self._scale)
         return logits
 
 
@@ -124,64 +136,70 @@ def evaluate_selective_inference(
         delattr(model, "inference_classifier")
     
     model.eval()
-    acc = 0.
+    correct = torch.zeros((), device='cuda')
     tot_samples = 0
     
     for i, (images, target) in enumerate(loader):
-        images, target = images.cuda(), target.cuda()
+        images, target = images.cuda(non_blocking=True), target.cuda(non_blocking=True)
         with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
             logits = model.infer(
                 images, 
                 categories=classnames, 
                 template=template, 
             )
-        acc += cls_acc(logits, target) * len(logits)
+        correct += num_correct(logits, target)
         tot_samples += len(logits)
     
-    acc /= tot_samples
+    acc = 100 * correct.item() / tot_samples
     return acc
 
 
-def train_epoch_second_stage(model, optimizer, scheduler, scaler, train_loader, count_iters, total_iters):
+def train_epoch_second_stage(model, optimizer, scheduler, scaler, train_loader, count_iters, total_iters, verbose=False):
     model.train()
-    acc_train = 0
+    amp_dtype = autocast_dtype()
+    acc_train = torch.zeros((), device='cuda')
     tot_samples = 0
-    loss_epoch = 0.
+    loss_epoch = torch.zeros((), device='cuda')
+
+    # by default only the last epoch is logged, so skip the bookkeeping for the others
+    log_epoch = verbose or count_iters + len(train_loader) >= total_iters
 
     for i, (images, target) in enumerate(train_loader):
         
-        # move data to GPU
-        images, target = images.cuda(), target.cuda()
+        # tell cuda graphs a new iteration starts (no-op unless the encoders are compiled)
+        torch.compiler.cudagraph_mark_step_begin()
+
+        # move data to GPU (channels_last matches the layout of the conv weights)
+        images = images.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        target = target.cuda(non_blocking=True)
 
         # get both text and image features
-        with torch.amp.autocast('cuda', dtype=torch.float16):
+        with torch.amp.autocast('cuda', dtype=amp_dtype):
             logits = model(images, no_grad_backbone=True)
         
         # compute loss and backward with scaling
-        loss = F.cross_entropy(logits, target)
+        loss = F.cross_entropy(logits.float(), target)
         scaler.scale(loss).backward()
         scaler.step(optimizer)
-        scale = scaler.get_scale()
         scaler.update()
-        skip_lr_sched = (scale > scaler.get_scale())
-        if not skip_lr_sched:
-            scheduler.step()
-            count_iters += 1
-        optimizer.zero_grad()
+        scheduler.step()
+        count_iters += 1
+        optimizer.zero_grad(set_to_none=True)
         
-        # compute accuracy and loss
-        acc_train += cls_acc(logits, target) * target.shape[0]
-        loss_epoch += loss.item() * target.shape[0]
-        tot_samples += target.shape[0]
+        # compute accuracy and loss (accumulated on the GPU, so no sync at every step)
+        if log_epoch:
+            acc_train += num_correct(logits, target)
+            loss_epoch += loss.detach() * target.shape[0]
+            tot_samples += target.shape[0]
         
         # check if we reached the total number of iterations
         if count_iters == total_iters:
             break
         
     # print after each epoch
-    if count_iters <= total_iters:
-        acc_train /= tot_samples
-        loss_epoch /= tot_samples
+    if log_epoch and count_iters <= total_iters:
+        acc_train = 100 * acc_train.item() / tot_samples
+        loss_epoch = loss_epoch.item() / tot_samples
         current_lr = scheduler.get_last_lr()[0]
         print('[{}/{}] LR: {:.6f}, Acc: {:.4f}, Loss: {:.4f}'.format(count_iters, total_iters, current_lr, acc_train, loss_epoch))
 
@@ -189,58 +207,51 @@ def train_epoch_second_stage(model, optimizer, scheduler, scaler, train_loader,
 
 
 
-def train_epoch(clip_model, optimizer, scheduler, scaler, train_loader, tokenized_texts, count_iters, total_iters, args):
+def train_epoch(clip_model, optimizer, scheduler, scaler, train_loader, tokenized_texts, count_iters, total_iters, args, frozen_text_features=None, graphed_step=None):
     clip_model.train()
-    acc_train = 0
+    acc_train = torch.zeros((), device='cuda')
     tot_samples = 0
-    loss_epoch = 0.
+    loss_epoch = torch.zeros((), device='cuda')
 
-    text_context_manager = torch.no_grad if args.ln_modality == 'vision' else nullcontext
-    vision_context_manager = torch.no_grad if args.ln_modality == 'text' else nullcontext
+    # by default only the last epoch is logged, so skip the bookkeeping for the others
+    log_epoch = args.verbose_every_epoch or args.debug or count_iters + len(train_loader) >= total_iters
+
+    train_step = make_train_step(clip_model, optimizer, scaler, tokenized_texts, args, frozen_text_features)
 
     for i, (images, target) in enumerate(train_loader):
         
-        # move data to GPU
-        images, target = images.cuda(), target.cuda()
+        # tell cuda graphs a new iteration starts (no-op unless the encoders are compiled)
+        torch.compiler.cudagraph_mark_step_begin()
 
-        # get both text and image features
-        # wrapping the forward pass in autocast
-        with torch.amp.autocast('cuda', dtype=torch.float16):
-            with text_context_manager():
-                text_features = clip_model.encode_text(tokenized_texts)
-            with vision_context_manager():
-                image_features = clip_model.encode_image(images)
-        
-        # well, you know that clip normalizes the features
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        
-        # compute loss and backward with scaling
-        cosine_similarity = clip_model.logit_scale.exp() * image_features @ text_features.t()
-        loss = F.cross_entropy(cosine_similarity, target)
-        scaler.scale(loss).backward()
-        scaler.step(optimizer)
-        scale = scaler.get_scale()
+        # move data to GPU (channels_last matches the layout of the conv weights)
+        images = images.cuda(non_blocking=True).to(memory_format=torch.channels_last)
+        target = target.cuda(non_blocking=True)
+
+        # replay the recorded CUDA graph on full batches, run the training step eagerly otherwise
+        if graphed_step is not None and target.shape[0] == graphed_step.batch_size:
+            cosine_similarity, loss = graphed_step(images, target)
+        else:
+            # the graph owns the gradient buffers, so they can only be zeroed in place
+            optimizer.zero_grad(set_to_none=graphed_step is None)
+            cosine_similarity, loss = train_step(images, target)
         scaler.update()
-        skip_lr_sched = (scale > scaler.get_scale())
-        if not skip_lr_sched:
-            scheduler.step()
-            count_iters += 1
-        optimizer.zero_grad()
+        scheduler.step()
+        count_iters += 1
         
-        # compute accuracy and loss
-        acc_train += cls_acc(cosine_similarity, target) * target.shape[0]
-        loss_epoch += loss.item() * target.shape[0]
-        tot_samples += target.shape[0]
+        # compute accuracy and loss (accumulated on the GPU, so no sync at every step)
+        if log_epoch:
+            acc_train += num_correct(cosine_similarity, target)
+            loss_epoch += loss.detach() * target.shape[0]
+            tot_samples += target.shape[0]
         
         # check if we reached the total number of iterations
         if count_iters == total_iters:
             break
         
     # print after each epoch
-    if count_iters <= total_iters:
-        acc_train /= tot_samples
-        loss_epoch /= tot_samples
+    if log_epoch and count_iters <= total_iters:
+        acc_train = 100 * acc_train.item() / tot_samples
+        loss_epoch = loss_epoch.item() / tot_samples
         current_lr = scheduler.get_last_lr()[0]
         print('[{}/{}] LR: {:.6f}, Acc: {:.4f}, Loss: {:.4f}'.format(count_iters, total_iters, current_lr, acc_train, loss_epoch))
 
@@ -253,9 +264,16 @@ def run_twostage(args, clip_model, logit_scale, dataset, train_loader, val_loade
     # train only layer-norm instances
     clip_model, trainable_params = prepare_for_first_stage(clip_model, args)
     clip_model = clip_model.float().cuda() 
+    if args.grad_ckpt:
+        clip_model = enable_grad_checkpointing(clip_model)
+    clip_model.visual = clip_model.visual.to(memory_format=torch.channels_last)
+    if args.compile:
+        clip_model = compile_encoders(clip_model)
     print(f"Trainable parameters: {num_params(clip_model, trainable=True):,}")    
     
-    optimizer = torch.optim.AdamW(trainable_params, lr=args.lr, weight_decay=args.wd, betas=(0.9, 0.999))
+    # a CUDA graph reads the lr from device memory, so it must be a tensor the scheduler updates in place
+    lr = torch.tensor(args.lr, device='cuda') if args.cuda_graph else args.lr
+    optimizer = torch.optim.AdamW(trainable_params, lr=lr, weight_decay=args.wd, betas=(0.9, 0.999), fused=True, capturable=bool(args.cuda_graph))
     print(f"Using AdamW with lr={args.lr}, wd={args.wd}, betas=(0.9, 0.999).")
     
     total_iters = args.n_iters * args.shots
@@ -263,12 +281,28 @@ def run_twostage(args, clip_model, logit_scale, dataset, train_loader, val_loade
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, cosine_iters, eta_min=1e-6)
     
     # training 
-    scaler = torch.amp.GradScaler('cuda')
+    # loss scaling is only needed when falling back to fp16
+    scaler = torch.amp.GradScaler('cuda', enabled=autocast_dtype() == torch.float16)
     count_iters = 0
 
     # we only need to tokenize once
     tokenized_texts = tokenize_texts(template=dataset.template[0], classnames=dataset.classnames)
 
+    # when only tuning the vision encoder, the text features never change: encode them once
+    frozen_text_features = encode_texts(clip_model, tokenized_texts, dtype=autocast_dtype()) if args.ln_modality == 'vision' else None
+
+    # optionally record the whole training step once, and replay it for every full batch
+    graphed_step = None
+    if args.cuda_graph:
+        clip_model.train()
+        graphed_step = capture_train_step(
+            make_train_step(clip_model, optimizer, scaler, tokenized_texts, args, frozen_text_features),
+            optimizer,
+            scaler,
+            train_loader,
+            resolution=clip_model.visual.input_resolution
+        )
+
     # start training for a fixed number of gradient steps (total_iters)  
     while count_iters < cosine_iters:
         clip_model, count_iters = train_epoch(
@@ -280,19 +314,23 @@ def run_twostage(args, clip_model, logit_scale, dataset, train_loader, val_loade
             tokenized_texts, 
             count_iters, 
             cosine_iters,
-            args
+            args,
+            frozen_text_features=frozen_text_features,
+            graphed_step=graphed_step
         )
 
         if args.debug: break
     
     # once the first stage is done, we freeze everything and exploit the learned layer-norms
-    model = SingleStreamClassifier(clip_model, dataset.classnames, template=dataset.template[0])
+    model = SingleStreamClassifier(clip_model, dataset.classnames, template=dataset.template[0], compile_backbone=args.compile)
+    model = freeze_all_but(model, [model.classifier])
     print("Initialized single stream classifier")
-    optimizer = torch.optim.AdamW([model.classifier], lr=args.lr, weight_decay=args.wd, betas=(0.9, 0.999))
+    optimizer = torch.optim.AdamW([model.classifier], lr=args.lr, weight_decay=args.wd, betas=(0.9, 0.999), fused=True)
     print(f"[Second Stage] Using AdamW with lr={args.lr}, wd={args.wd}, betas=(0.9, 0.999).")
     
     # training 
-    scaler = torch.amp.GradScaler('cuda')
+    # loss scaling is only needed when falling back to fp16
+    scaler = torch.amp.GradScaler('cuda', enabled=autocast_dtype() == torch.float16)
     second_stage_iters = total_iters - count_iters
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, second_stage_iters, eta_min=1e-6)
 
@@ -305,7 +343,8 @@ def run_twostage(args, clip_model, logit_scale, dataset, train_loader, val_loade
             scaler,
             train_loader,
             count_iters,
-            total_iters
+            total_iters,
+            verbose=args.verbose_every_epoch or args.debug
         )
         if args.debug: break
 
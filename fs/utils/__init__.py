@@ -1,2 +1,3 @@
 from .eval_utils import *
-from .model_utils import *
\ No newline at end of file
+from .model_utils import *
+from .train_utils import *
\ No newline at end of file
@@ -4,12 +4,17 @@ import torch
 import os.path as osp
 
 
+def num_correct(output, target):
+    # stays on the GPU, so it can be accumulated across batches without syncing
+    return (output.argmax(dim=-1) == target).sum()
+
+
 def cls_acc(output, target, topk=1):
-    pred = output.topk(topk, 1, True, True)[1].t()
-    correct = pred.eq(target.view(1, -1).expand_as(pred))
-    acc = float(correct[: topk].reshape(-1).float().sum(0, keepdim=True).cpu().numpy())
-    acc = 100 * acc / target.shape[0]
-    return acc
+    if topk == 1:
+        return 100 * num_correct(output, target).item() / target.shape[0]
+    pred = output.topk(topk, 1, True, True)[1]
+    correct = pred.eq(target.view(-1, 1)).any(dim=1)
+    return 100 * correct.sum().item() / target.shape[0]
 
 
 def clip_classifier(classnames, template, clip_model):
@@ -19,7 +24,7 @@ def clip_classifier(classnames, template, clip_model):
             # Tokenize the prompts
             classname = classname.replace('_', ' ')
             texts = [t.format(classname) for t in template]
-            texts = clip.tokenize(texts).cuda()
+            texts = clip.tokenize(texts).pin_memory().cuda(non_blocking=True)
             class_embeddings = clip_model.encode_text(texts)
             class_embeddings /= class_embeddings.norm(dim=-1, keepdim=True)
             class_embedding = class_embeddings.mean(dim=0)
@@ -34,7 +39,7 @@ def pre_load_features(clip_model, loader):
     features, labels = [], []
     with torch.no_grad():
         for i, (images, target) in enumerate(loader):
-            images, target = images.cuda(), target.cuda()
+            images, target = images.cuda(non_blocking=True), target.cuda(non_blocking=True)
             image_features = clip_model.encode_image(images)
             image_features /= image_features.norm(dim=-1, keepdim=True)
             features.append(image_features.to('cpu', non_blocking=True))
@@ -74,29 +79,40 @@ def zero_shot_eval(clip_model, dataset, loader, split="test"):
 def evaluate(clip_model, loader, template, classnames):
     clip_model.eval()
     texts = tokenize_texts(template, classnames)
-    with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
-        class_embeddings = clip_model.encode_text(texts)
-    text_features = class_embeddings / class_embeddings.norm(dim=-1, keepdim=True)
+    text_features = encode_texts(clip_model, texts)
 
-    acc = 0.
+    correct = torch.zeros((), device='cuda')
     tot_samples = 0
     for i, (images, target) in enumerate(loader):
-        images, target = images.cuda(), target.cuda()
+        images, target = images.cuda(non_blocking=True), target.cuda(non_blocking=True)
         with torch.amp.autocast(device_type="cuda", dtype=torch.float16):
             image_features = clip_model.encode_image(images)
         image_features = image_features/image_features.norm(dim=-1, keepdim=True)
         cosine_similarity = image_features @ text_features.t()
-        acc += cls_acc(cosine_similarity, target) * len(cosine_similarity)
+        correct += num_correct(cosine_similarity, target)
         tot_samples += len(cosine_similarity)
     
-    acc /= tot_samples
+    acc = 100 * correct.item() / tot_samples
     return acc
 
 
 def tokenize_texts(template, classnames, device='cuda'):
     texts = [template.format(classname.replace('_', ' ')) for classname in classnames]
-    tokenized_texts = clip.tokenize(texts).to(device)
-    return tokenized_texts 
+    tokenized_texts = clip.tokenize(texts)
+    if torch.device(device).type == 'cuda':
+        tokenized_texts = tokenized_texts.pin_memory()
+    return tokenized_texts.to(device, non_blocking=True)
+
+
+@torch.no_grad()
+def encode_texts(clip_model, tokenized_texts, dtype=torch.float16, batch_size=512):
+    # encode in chunks, so that many categories (e.g., ImageNet) don't make a single huge batch
+    text_features = []
+    for i in range(0, len(tokenized_texts), batch_size):
+        with torch.amp.autocast(device_type="cuda", dtype=dtype):
+            class_embeddings = clip_model.encode_text(tokenized_texts[i: i + batch_size])
+        text_features.append(class_embeddings / class_embeddings.norm(dim=-1, keepdim=True))
+    return torch.cat(text_features)
 
 
 def dump(result: dict, args: dict, decimals: int = 4):
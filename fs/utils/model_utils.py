@@ -2,6 +2,26 @@ import torch
 import torch.nn as nn
 import clip
 
+try:
+    from apex.normalization import FusedLayerNorm
+except ImportError:
+    FusedLayerNorm = None
+
+
+if FusedLayerNorm is not None:
+    class FusedFP32LayerNorm(FusedLayerNorm):
+        """Apex's FusedLayerNorm, computing in fp32 like clip.model.LayerNorm."""
+
+        def forward(self, x: torch.Tensor):
+            orig_type = x.dtype
+            with torch.amp.autocast('cuda', enabled=False):
+                ret = super().forward(x.type(torch.float32))
+            return ret.type(orig_type)
+
+    NORM_LAYERS = (nn.LayerNorm, FusedLayerNorm)
+else:
+    NORM_LAYERS = (nn.LayerNorm,)
+
 
 def named_modules_with_index(clip_model: nn.Module):
     assert hasattr(clip_model, "visual") and hasattr(clip_model.visual, "transformer") and hasattr(clip_model, "transformer"), \
@@ -23,13 +43,27 @@ def named_modules_with_index(clip_model: nn.Module):
             yield name, module, block_idx
 
 
+def fuse_layer_norms(model):
+    if FusedLayerNorm is None:
+        print("Apex is not installed, falling back to PyTorch's LayerNorm.")
+        return model
+    for parent in list(model.modules()):
+        for child_name, child in parent.named_children():
+            if isinstance(child, nn.LayerNorm):
+                fused = FusedFP32LayerNorm(child.normalized_shape, eps=child.eps, elementwise_affine=child.elementwise_affine)
+                fused.load_state_dict(child.state_dict())
+                setattr(parent, child_name, fused.to(child.weight))
+    print("Replaced all LayerNorm instances with Apex's FusedLayerNorm.")
+    return model
+
+
 def trainable_norm_params(model, modality='both', vision_start=0, text_start=0):
     assert modality in ('both', 'vision', 'text')
     trainable_params = []
     for name, module, block_idx in named_modules_with_index(model):
         curr_modality = 'vision' if 'visual' in name else 'text'
         curr_index = vision_start if curr_modality == 'vision' else text_start
-        if isinstance(module, torch.nn.LayerNorm) and block_idx >= curr_index and (modality == 'both' or modality == curr_modality):
+        if isinstance(module, NORM_LAYERS) and block_idx >= curr_index and (modality == 'both' or modality == curr_modality):
             trainable_params.extend(list(module.parameters()))
             module.requires_grad_(True)
             print(f"Modality = {modality}, vision_start={vision_start}, text_start={text_start} ==> LayerNorm at {name} is trainable.")
@@ -56,6 +90,42 @@ def trainable_bias_params(model, modality='both', vision_start=0, text_start=0):
     return trainable_params
 
 
+def autocast_dtype():
+    # bf16 has the same range as fp32, so no loss scaling is needed where it is natively supported (Ampere+)
+    if torch.cuda.is_bf16_supported(including_emulation=False):
+        return torch.bfloat16
+    return torch.float16
+
+
+def compile_encoders(clip_model):
+    # train/eval batches and the different sets of prompts all have their own shapes, so allow a few more graphs
+    torch._dynamo.config.cache_size_limit = 64
+    clip_model.encode_image = torch.compile(clip_model.encode_image, mode="reduce-overhead", dynamic=False)
+    clip_model.encode_text = torch.compile(clip_model.encode_text, mode="reduce-overhead", dynamic=False)
+    print("Compiled CLIP encoders with torch.compile(mode='reduce-overhead').")
+    return clip_model
+
+
+def freeze_all_but(model, trainable_params):
+    # autograd only records (and keeps activations for) ops that involve the trainable parameters
+    trainable_ids = {id(p) for p in trainable_params}
+    for param in model.parameters():
+        param.requires_grad_(id(param) in trainable_ids)
+    return model
+
+
+def enable_grad_checkpointing(clip_model, segments=4):
+    # only kicks in for towers that run with gradients, frozen ones already keep no activations
+    # call it after LoRA is applied: plain CLIP blocks are deterministic, so the RNG state only needs to be
+    # restored for recomputation if LoRA added dropout (saving it also breaks CUDA graph capture)
+    for transformer in (getattr(clip_model.visual, "transformer", None), clip_model.transformer):
+        if transformer is not None: # RN backbones have no visual transformer
+            transformer.checkpoint_segments = segments
+            transformer.checkpoint_preserve_rng = any(isinstance(m, nn.Dropout) and m.p > 0 for m in transformer.resblocks.modules())
+    print(f"Enabled gradient checkpointing on the CLIP transformers ({segments} segments).")
+    return clip_model
+
+
 def num_params(model, trainable=True):
     if trainable:
         return sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -0,0 +1,92 @@
+import torch
+import torch.nn.functional as F
+
+from contextlib import nullcontext
+from fs.utils.model_utils import autocast_dtype
+
+
+def make_train_step(clip_model, optimizer, scaler, tokenized_texts, args, frozen_text_features=None):
+    amp_dtype = autocast_dtype()
+    logit_scale = clip_model.logit_scale.detach().exp().item() # the temperature is never trained
+    text_context_manager = torch.no_grad if args.ln_modality == 'vision' else nullcontext
+    vision_context_manager = torch.no_grad if args.ln_modality == 'text' else nullcontext
+
+    def train_step(images, target):
+        # get both text and image features (unless the text ones are frozen and cached)
+        # wrapping the forward pass in autocast (weights are used once per step, and its cache breaks CUDA graphs)
+        with torch.amp.autocast('cuda', dtype=amp_dtype, cache_enabled=False):
+            if frozen_text_features is None:
+                with text_context_manager():
+                    text_features = clip_model.encode_text(tokenized_texts)
+            with vision_context_manager():
+                image_features = clip_model.encode_image(images)
+
+        # well, you know that clip normalizes the features
+        if frozen_text_features is None:
+            text_features = F.normalize(text_features, dim=-1)
+        else:
+            text_features = frozen_text_features
+        image_features = F.normalize(image_features, dim=-1)
+
+        # compute loss and backward with scaling
+        cosine_similarity = F.linear(image_features, text_features).mul_(logit_scale)
+        loss = F.cross_entropy(cosine_similarity.float(), target)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        return cosine_similarity, loss
+
+    return train_step
+
+
+def capture_train_step(train_step, optimizer, scaler, train_loader, resolution, warmup_iters=3):
+    """Record `train_step` (forward, backward and optimizer update) in a CUDA graph.
+
+    The warm-up updates needed before capturing are rolled back, so the returned step can be used
+    from the very first iteration. It only accepts full batches; returns None if capturing is not possible.
+    """
+    batch_size = train_loader.batch_size
+    if scaler.is_enabled():
+        print("Loss scaling can't be captured in a CUDA graph (no bf16 support?), running the training step eagerly.")
+        return None
+    if len(train_loader.dataset) < batch_size:
+        print("No full training batch to capture in a CUDA graph, running the training step eagerly.")
+        return None
+
+    params = [p for group in optimizer.param_groups for p in group["params"]]
+    initial_params = [p.detach().clone() for p in params]
+    static_images = torch.zeros(batch_size, 3, resolution, resolution, device='cuda').to(memory_format=torch.channels_last)
+    static_target = torch.zeros(batch_size, dtype=torch.long, device='cuda')
+
+    # warm up on a side stream, so that lazy initializations (e.g., the optimizer state) happen before capturing
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(warmup_iters):
+            optimizer.zero_grad(set_to_none=True)
+            train_step(static_images, static_target)
+    torch.cuda.current_stream().wait_stream(stream)
+
+    # gradients allocated during the capture belong to the graph, and each replay overwrites them
+    graph = torch.cuda.CUDAGraph()
+    optimizer.zero_grad(set_to_none=True)
+    with torch.cuda.graph(graph):
+        static_logits, static_loss = train_step(static_images, static_target)
+
+    # undo the warm-up updates: restore the weights and start again from a fresh optimizer state
+    with torch.no_grad():
+        for param, initial_param in zip(params, initial_params):
+            param.copy_(initial_param)
+        for state in optimizer.state.values():
+            for value in state.values():
+                if torch.is_tensor(value):
+                    value.zero_()
+
+    def graphed_train_step(images, target):
+        static_images.copy_(images)
+        static_target.copy_(target)
+        graph.replay()
+        return static_logits, static_loss
+
+    graphed_train_step.batch_size = batch_size
+    print(f"Captured the training step in a CUDA graph (batches of {batch_size}).")
+    return graphed_train_step
@@ -48,6 +48,14 @@ def get_arguments():
     # training arguments
     parser.add_argument('--lr', default=2e-4, type=float)
     parser.add_argument('--wd', default=1e-2, type=float)
+    parser.add_argument('--cudnn_benchmark', default=False, type=int,
+                        help="Let cuDNN autotune convolution algorithms. Faster, but runs are no longer bitwise reproducible. Default: False.")
+    parser.add_argument('--grad_ckpt', default=False, type=int,
+                        help="Gradient checkpointing on the transformer blocks that are trained: less memory for larger batches, more compute. With --peft lora, it can't be combined with --cuda_graph unless --dropout_rate is 0. Default: False.")
+    parser.add_argument('--compile', default=False, type=int,
+                        help="Compile the CLIP encoders with torch.compile(mode='reduce-overhead'). Pays off on long runs. Default: False.")
+    parser.add_argument('--cuda_graph', default=False, type=int,
+                        help="Record the first-stage training step in a CUDA graph and replay it on full batches (needs bf16). Default: False.")
     
     # experiment config
     parser.add_argument('--mode', type=str, default='twostage', choices=['cliplora', 'ln_only', 'twostage'],
@@ -56,6 +64,8 @@ def get_arguments():
                         help="Setting for the experiment. Set to 'standard' for all-to-all (train categories = eval categories) or 'base2new' otherwise.")
     parser.add_argument('--debug', default=False, type=int, 
                         help='Enable debugging mode (will run for a few iterations, then exit). Useful to check installation was successful.')
+    parser.add_argument('--verbose_every_epoch', default=False, type=int,
+                        help='Log training accuracy and loss after every epoch instead of only after the last one (costs a GPU sync per step). Default: False.')
     parser.add_argument('--results_dir', type=str, default='results', help="Root folder to where your .csv results will be saved.")
     parser.add_argument('--exp_name', type=str, default='mycoolname', help="Experiment name (will be the basename of your .csv file).")
 
@@ -75,6 +85,8 @@ def get_arguments():
                          " Active if --ln_modality is 'both' or 'vision'. Default: 0 (tunes all instances).")
     parser.add_argument('--ln_text_start', default=0, type=int, 
                         help="Same as --ln_vision_start, but for the text encoder (therefore, active if --ln_modality is 'both' or 'text'). Default: 0.")
+    parser.add_argument('--fused_ln', default=False, type=int,
+                        help="Swap LayerNorm instances for Apex's FusedLayerNorm (needs apex, otherwise a no-op). Default: False.")
     
     # if you set --peft=lora or --mode=cliplora, then you may also wanna set these LoRA arguments 
     # NOTE: (all of the remaining args below are borrowed from CLIP-LoRA, no changes)
@@ -88,12 +100,16 @@ def get_arguments():
     parser.add_argument('--filename', default='lora_weights', help='file name to save the lora weights (.pt extension will be added)')
     
     args = parser.parse_args()
+    assert not (args.compile and args.cuda_graph), "--compile already relies on CUDA graphs, use either --compile or --cuda_graph."
+    assert not (args.grad_ckpt and args.cuda_graph and args.peft == 'lora' and args.dropout_rate > 0), \
+        "--grad_ckpt saves the RNG state for the LoRA dropout, which can't be recorded in a CUDA graph: set --dropout_rate 0 or drop one of the two."
     return args
 
 
 def main(args):
     time_in = time.time()
     reproducible_setup(args.seed)    
+    torch.backends.cudnn.benchmark = bool(args.cudnn_benchmark)
     
     # initialize clip model
     clip_model, preprocess = clip.load(args.backbone)